@@ -11,13 +11,61 @@ from sklearn.tree import DecisionTreeClassifier, export_graphviz
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.model_selection import cross_val_score
 from pydot import graph_from_dot_data
+from joblib import Parallel, delayed
+from numba import njit, prange
 import io
 
 import random
 random.seed(246810)
 np.random.seed(246810)
 
-eps = 1e-5  # a small number
+
+@njit(fastmath=True, cache=True)
+def _scaled_entropy(counts, clog):
+    # n * H = n * log2(n) - sum(c * log2(c)) for a vector of class counts
+    # summing to n, read from the table clog[c] = c * log2(c)
+    n = 0
+    total = 0.0
+    for c in counts:
+        n += c
+        total += clog[c]
+    return clog[n] - total
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def best_split(X, y, sorted_idx, n_classes):
+    # Best information-gain split of every feature. Each presorted column is
+    # walked once, moving rows from the right counts to the left, and the
+    # boundary between every pair of distinct values is scored. Features
+    # without any such boundary keep a gain of -1.
+    n, d = sorted_idx.shape
+    gains = np.full(d, -1.0)
+    thresh = np.zeros(d)
+    # counts never exceed n, so every c * log2(c) the scan needs is
+    # tabulated once instead of calling log2 at each boundary
+    clog = np.zeros(n + 1)
+    for c in range(1, n + 1):
+        clog[c] = c * np.log2(c)
+    total = np.zeros(n_classes, np.int64)
+    for r in range(n):
+        total[y[sorted_idx[r, 0]]] += 1
+    start = _scaled_entropy(total, clog) / n
+    for j in prange(d):
+        left = np.zeros(n_classes, np.int64)
+        right = total.copy()
+        for r in range(n - 1):
+            row = sorted_idx[r, j]
+            left[y[row]] += 1
+            right[y[row]] -= 1
+            lo, hi = X[row, j], X[sorted_idx[r + 1, j], j]
+            if lo == hi:
+                continue
+            gain = start - (_scaled_entropy(left, clog) +
+                            _scaled_entropy(right, clog)) / n
+            if gain > gains[j]:
+                gains[j] = gain
+                thresh[j] = lo + (hi - lo) / 2
+    return gains, thresh
 
 
 class DecisionTree:
@@ -27,19 +75,20 @@ class DecisionTree:
         self.features = feature_labels
         self.left, self.right = None, None  # for non-leaf nodes
         self.split_idx, self.thresh = None, None  # for non-leaf nodes
-        self.data, self.pred = None, None  # for leaf nodes
+        self.n_samples, self.pred = None, None  # for leaf nodes
 
     @staticmethod
     def entropy(y):
-        e=0
-        if not len(t):
-            return e
-        temp = np.unique(t)
-        for i in temp:
-            temp2 = len(np.where(t == i))
-            p = temp2 / len(t)
-            e -= p * np.log2(p)
-        return e
+        y = np.asarray(y)
+        if not y.size:
+            return 0.0
+        if y.dtype.kind in 'iu' and y.min() >= 0:
+            counts = np.bincount(y)
+        else:
+            # negative or non-integer labels: count them via np.unique
+            counts = np.unique(y, return_counts=True)[1]
+        p = counts[counts > 0] / y.size
+        return -np.sum(p * np.log2(p))
 
     @staticmethod
     def information_gain(X, y, thresh):
@@ -62,61 +111,72 @@ class DecisionTree:
         # TODO
         return DecisionTree.gini_impurity(X, y, thresh)
 
-    def split(self, X, y, idx, thresh):
-        X0, idx0, X1, idx1 = self.split_test(X, idx=idx, thresh=thresh)
-        y0, y1 = y[idx0], y[idx1]
-        return X0, y0, X1, y1
-
-    def split_test(self, X, idx, thresh):
-        idx0 = np.where(X[:, idx] < thresh)[0]
-        idx1 = np.where(X[:, idx] >= thresh)[0]
-        X0, X1 = X[idx0, :], X[idx1, :]
-        return X0, idx0, X1, idx1
-
-    def fit(self, X, y):
+    @staticmethod
+    def partition_sorted(X, sorted_idx, idx, thresh):
+        # split per-feature sorted row orders between the two children; the
+        # relative order is preserved so neither child needs to sort again
+        d = sorted_idx.shape[1]
+        in_left = (X[sorted_idx, idx] < thresh).T
+        left = sorted_idx.T[in_left].reshape(d, -1).T
+        right = sorted_idx.T[~in_left].reshape(d, -1).T
+        return left, right
+
+    def fit(self, X, y, sorted_idx=None, classes=None, codes=None):
+        # Nodes are described by sorted_idx, the rows of X belonging to the
+        # node ordered by each feature, so X and y are never copied while
+        # recursing.
+        if sorted_idx is None:
+            sorted_idx = np.argsort(X, axis=0, kind='stable')
+        if codes is None:
+            # recode labels to 0..C-1 once for the split kernel and leaves
+            classes, codes = np.unique(y, return_inverse=True)
+        rows = sorted_idx[:, 0]
         if self.max_depth > 0:
             # compute entropy gain for all single-dimension splits,
-            # thresholding with a linear interpolation of 10 values
-            gains = []
-            # The following logic prevents thresholding on exactly the minimum
-            # or maximum values, which may not lead to any meaningful node
-            # splits.
-            thresh = np.array([
-                np.linspace(np.min(X[:, i]) + eps, np.max(X[:, i]) - eps, num=10)
-                for i in range(X.shape[1])
-            ])
-            for i in range(X.shape[1]):
-                gains.append([self.information_gain(X[:, i], y, t) for t in
-            thresh[i, :]])
-            gains = np.nan_to_num(np.array(gains))
-            self.split_idx, thresh_idx = np.unravel_index(np.argmax(gains),
-                gains.shape)
-            self.thresh = thresh[self.split_idx, thresh_idx]
-            X0, y0, X1, y1 = self.split(X, y, idx=self.split_idx,
-                thresh=self.thresh)
-            if X0.size > 0 and X1.size > 0:
+            # thresholding halfway between every pair of adjacent values
+            gains, thresh = best_split(X, codes, sorted_idx, len(classes))
+            self.split_idx = np.argmax(gains)
+            self.thresh = thresh[self.split_idx]
+            sorted0, sorted1 = self.partition_sorted(
+                X, sorted_idx, self.split_idx, self.thresh)
+            if sorted0.shape[0] > 0 and sorted1.shape[0] > 0:
                 self.left = DecisionTree(max_depth=self.max_depth - 1, feature_labels=self.features)
-                self.left.fit(X0, y0)
+                self.left.fit(X, y, sorted_idx=sorted0, classes=classes,
+                              codes=codes)
                 self.right = DecisionTree(max_depth=self.max_depth - 1, feature_labels=self.features)
-                self.right.fit(X1, y1)
+                self.right.fit(X, y, sorted_idx=sorted1, classes=classes,
+                               codes=codes)
             else:
                 self.max_depth = 0
-                self.data, self.labels = X, y
-                self.pred = stats.mode(y, keepdims=True).mode[0]
+                self.n_samples = rows.size
+                self.pred = classes[np.bincount(codes[rows]).argmax()]
         else:
-            self.data, self.labels = X, y
-            self.pred = stats.mode(y, keepdims=True).mode[0]
+            self.n_samples = rows.size
+            self.pred = classes[np.bincount(codes[rows]).argmax()]
         return self
 
     def __repr__(self):
         if self.max_depth == 0:
-            return "%s (%s)" % (self.pred, self.labels.size)
+            return "%s (%s)" % (self.pred, self.n_samples)
         else:
             return "[%s < %s: %s | %s]" % (self.features[self.split_idx],
                                            self.thresh, self.left.__repr__(),
                                            self.right.__repr__())
 
 
+def _fit_one(seed, X, y, params):
+    # fit a single bagged tree on a bootstrap sample drawn from its own seed,
+    # so results do not depend on which worker runs it; also returns the
+    # out-of-bag rows and the tree's predictions for them
+    indices = np.random.RandomState(seed).randint(0, len(X), len(X))
+    tree = DecisionTreeClassifier(random_state=seed, **params)
+    tree.fit(X[indices], y[indices])
+    oob = np.ones(len(X), dtype=bool)
+    oob[indices] = False
+    oob = np.flatnonzero(oob)
+    return tree, oob, tree.predict(X[oob])
+
+
 class BaggedTrees(BaseEstimator, ClassifierMixin):
 
     def __init__(self, params=None, n=200):
@@ -124,24 +184,43 @@ class BaggedTrees(BaseEstimator, ClassifierMixin):
             params = {}
         self.params = params
         self.n = n
-        self.decision_trees = [
-            DecisionTreeClassifier(random_state=i, **self.params)
-            for i in range(self.n)
-        ]
 
     def fit(self, X, y):
-        # TODO
-        for tree in self.decision_trees:
-            indices = np.random.choice(len(X), size=len(X), replace=True)
-            tree.fit(X[indices], y[indices])
-
+        # Trees are independent, so train them in parallel. Each worker builds
+        # its own estimator, and X/y above max_nbytes are shared with the
+        # workers as a read-only memmap instead of being pickled per tree.
+        self.classes_ = np.unique(y)
+        results = Parallel(n_jobs=-1, prefer='processes', max_nbytes='1M',
+                           mmap_mode='r')(
+            delayed(_fit_one)(i, X, y, self.params) for i in range(self.n))
+        self.decision_trees = [tree for tree, _, _ in results]
+        # Accuracy on the samples left out of each bootstrap, voting only
+        # with the trees that did not see them; a free generalization estimate
+        oob_votes = np.zeros((len(self.classes_), len(X)), dtype=np.int16)
+        for _, oob, pred in results:
+            oob_votes[np.searchsorted(self.classes_, pred), oob] += 1
+        voted = oob_votes.any(axis=0)
+        self.oob_score_ = np.mean(
+            self.classes_[oob_votes[:, voted].argmax(axis=0)] == y[voted])
+        return self
 
     def predict(self, X):
-        # TODO
-        predictions = np.zeros((len(X), self.n))
-        for i, tree in enumerate(self.decision_trees):
-            predictions[:, i] = tree.predict(X)
-        return mode(predictions, axis=1)[0].ravel()
+        # majority vote, tallied per class into a small integer array
+        # rather than stacking every tree's predictions and taking the mode
+        predictions = Parallel(n_jobs=-1)(
+            delayed(tree.predict)(X) for tree in self.decision_trees)
+        if len(self.classes_) == 2:
+            # binary labels: a single count of votes for the second class,
+            # with ties going to the first class as argmax would
+            votes = np.zeros(len(X), dtype=np.int16)
+            for pred in predictions:
+                votes += pred == self.classes_[1]
+            return self.classes_[(2 * votes > len(predictions)).astype(np.intp)]
+        votes = np.zeros((len(self.classes_), len(X)), dtype=np.int16)
+        cols = np.arange(len(X))
+        for pred in predictions:
+            votes[np.searchsorted(self.classes_, pred), cols] += 1
+        return self.classes_[votes.argmax(axis=0)]
 
 
 class RandomForest(BaggedTrees):
@@ -180,34 +259,48 @@ def preprocess(data, fill_mode=True, min_freq=10, onehot_cols=[]):
     onehot_encoding = []
     onehot_features = []
     for col in onehot_cols:
-        counter = Counter(data[:, col])
-        for term in counter.most_common():
-            if term[0] == b'-1':
-                continue
-            if term[-1] <= min_freq:
-                break
-            onehot_features.append(term[0])
-            onehot_encoding.append((data[:, col] == term[0]).astype(float))
+        # Factorize the column in one pass, then one-hot the frequent terms
+        # (most common first, ties in order of appearance) from the codes
+        terms, first, codes, counts = np.unique(
+            data[:, col], return_index=True, return_inverse=True,
+            return_counts=True)
+        order = np.lexsort((first, -counts))
+        keep = order[(counts[order] > min_freq) & (terms[order] != b'-1')]
+        onehot_features.extend(terms[keep])
+        # map each code to its one-hot column (-1 if dropped) and scatter,
+        # so no further comparisons of the byte strings or codes are needed
+        onehot_col = np.full(len(terms), -1)
+        onehot_col[keep] = np.arange(len(keep))
+        onehot_col = onehot_col[codes]
+        hit = np.flatnonzero(onehot_col >= 0)
+        onehot = np.zeros((len(codes), len(keep)), dtype=np.float32)
+        onehot[hit, onehot_col[hit]] = 1
+        onehot_encoding.append(onehot)
         data[:, col] = '0'
-    onehot_encoding = np.array(onehot_encoding).T
-    data = np.hstack(
-        [np.array(data, dtype=float),
-         np.array(onehot_encoding)])
+    data = np.hstack([np.array(data, dtype=float)] + onehot_encoding)
 
     # Replace missing data with the mode value. We use the mode instead of
     # the mean or median because this makes more sense for categorical
     # features such as gender or cabin type, which are not ordered.
     if fill_mode:
-        # TODO
-        modes = stats.mode(data, axis=0)
+        missing = data == -1
+        modes = np.full(data.shape[1], -1.0)
         for i, col in enumerate(data.T):
-            col[col == -1] = modes[0][0][i]
+            terms, counts = np.unique(col[~missing[:, i]], return_counts=True)
+            if terms.size:
+                modes[i] = terms[counts.argmax()]
+        data = np.where(missing, modes, data)
 
     return data, onehot_features
 
 
 def evaluate(clf):
-    print("Cross validation", cross_val_score(clf, X, y))
+    if hasattr(clf, "oob_score_"):
+        # bagged ensembles already hold an out-of-bag estimate, so skip
+        # retraining every tree for each cross validation fold
+        print("OOB score", clf.oob_score_)
+    else:
+        print("Cross validation", cross_val_score(clf, X, y))
     if hasattr(clf, "decision_trees"):
         counter = Counter([t.tree_.feature[0] for t in clf.decision_trees])
         first_splits = [
@@ -266,6 +359,11 @@ if __name__ == "__main__":
     else:
         raise NotImplementedError("Dataset %s not handled" % dataset)
 
+    # sklearn trees work in contiguous float32 internally; converting once
+    # here saves a copy on every fit
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    Z = np.ascontiguousarray(Z, dtype=np.float32)
+
     print("Features", features)
     print("Train/test size", X.shape, Z.shape)
     
@@ -15,9 +15,8 @@ and scraped from Flickr in 2024. The image features were extracted using CLIP Vi
 import matplotlib.pyplot as plt
 import numpy as np
 
-from sklearn.linear_model import LinearRegression
 from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
+from sklearn.metrics.pairwise import euclidean_distances
 from sklearn.neighbors import NearestNeighbors
 from PIL import Image
 
@@ -41,8 +40,10 @@ def plot_data(train_feats, train_labels):
 
     # Run PCA on training_feats
     ##### TODO(a): Your Code Here #####
-    transformed_feats = StandardScaler().fit_transform(train_feats)
-    transformed_feats = PCA(n_components=2).fit_transform(transformed_feats)
+    # Only two components are needed, so a randomized SVD of the centered
+    # (float32) features is enough; per-feature scaling is skipped for the plot
+    transformed_feats = PCA(n_components=2, svd_solver='randomized',
+                            random_state=0).fit_transform(train_feats)
 
     # Plot images by first two PCA dimensions (use marker='.' for better visibility)
     plt.scatter(transformed_feats[:, 0],     # Select first column
@@ -54,14 +55,35 @@ def plot_data(train_feats, train_labels):
     plt.show()
 
 
-def grid_search(train_features, train_labels, test_features, test_labels, is_weighted=False, verbose=True):
+def prefix_neighbors(test_train_distances, num_samples, k):
+    """
+    Input:
+        test_train_distances: [N_test, N_train] feature space distances from each test image to each training image
+        num_samples: Only the first num_samples training images are candidates
+        k: Number of neighbors to return
+
+    Output:
+        (distances, indices) of the k nearest candidates for each test image, sorted by distance
+    """
+    candidates = test_train_distances[:, :num_samples]
+    indices = np.argpartition(candidates, k - 1, axis=1)[:, :k]
+    distances = np.take_along_axis(candidates, indices, axis=1)
+    order = np.argsort(distances, axis=1)
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def grid_search(train_features, train_labels, test_features, test_labels, is_weighted=False, verbose=True,
+                neighbors=None):
     """
     Input:
         train_features: Training set image features
-        train_labels: Training set GPS (lat, lon) coords
+        train_labels: Training set GPS (lat, lon) coords, scaled to miles
         test_features: Test set image features
-        test_labels: Test set GPS (lat, lon) coords
+        test_labels: Test set GPS (lat, lon) coords, scaled to miles
         is_weighted: Weight prediction by distances in feature space
+        neighbors: Optional precomputed (distances, indices) of the 100 nearest training images for each test
+            image, sorted by distance; the neighbor search is skipped when given, and train_features and
+            test_features are then unused (train_features may be None)
 
     Output:
         Prints mean displacement error as a function of k
@@ -73,34 +95,35 @@ def grid_search(train_features, train_labels, test_features, test_labels, is_wei
     # Evaluate mean displacement error (in miles) of kNN regression for different values of k
     # Technically we are working with spherical coordinates and should be using spherical distances, but within a small
     # region like Spain we can get away with treating the coordinates as cartesian coordinates.
-    knn = NearestNeighbors(n_neighbors=100).fit(train_features)
-
     if verbose:
         print(f'Running grid search for k (is_weighted={is_weighted})')
 
     ks = list(range(1, 11)) + [20, 30, 40, 50, 100]
+    # Neighbors come back sorted by distance, so query the largest k once and
+    # take the first k columns for each smaller k
+    if neighbors is None:
+        # With 768-dim features tree-based indexes are slower than brute force,
+        # which computes all distances as BLAS matrix products
+        knn = NearestNeighbors(n_neighbors=100, algorithm='brute', n_jobs=-1).fit(
+            np.asarray(train_features, dtype=np.float32))
+        neighbors = knn.kneighbors(np.asarray(test_features, dtype=np.float32), n_neighbors=max(ks))
+    all_distances, all_indices = neighbors
     mean_errors = []
     for k in ks:
-        distances, indices = knn.kneighbors(test_features, n_neighbors=k)
-
-        errors = []
-        for i, nearest in enumerate(indices):
-            # Evaluate mean displacement error in miles for each test image
-            # Assume 1 degree latitude is 69 miles and 1 degree longitude is 52 miles
-            y = test_labels[i]
-
-            ##### TODO(d): Your Code Here #####
-            if is_weighted:
-                # Weight prediction by inverse of distances in feature space
-                weights = 1 / (distances[i] + 1e-8)  # Adding a small value to avoid division by zero
-                weighted_mean_coords = np.average(train_labels[nearest], axis=0, weights=weights)
-                displacement_error = np.sqrt(np.sum((y - weighted_mean_coords) ** 2)) * np.array([69, 52])
-            else:
-                # Predict by averaging coordinates of nearest neighbors
-                predicted_coords = np.mean(train_labels[nearest], axis=0)
-                displacement_error = np.sqrt(np.sum((y - predicted_coords) ** 2)) * np.array([69, 52])
-
-            errors.append(displacement_error)
+        distances, indices = all_distances[:, :k], all_indices[:, :k]
+
+        # Evaluate mean displacement error in miles for all test images at once
+        # (labels are already scaled to miles, see main)
+        ##### TODO(d): Your Code Here #####
+        neighbor_labels = train_labels[indices]  # [N_test, k, 2]
+        if is_weighted:
+            # Weight prediction by inverse of distances in feature space
+            weights = 1 / (distances + 1e-8)  # Adding a small value to avoid division by zero
+            predicted_coords = (neighbor_labels * weights[..., None]).sum(axis=1) / weights.sum(axis=1, keepdims=True)
+        else:
+            # Predict by averaging coordinates of nearest neighbors
+            predicted_coords = neighbor_labels.mean(axis=1)
+        errors = np.linalg.norm(test_labels - predicted_coords, axis=1)
 
         # Calculate the mean displacement error for the current value of k
         mean_error = np.mean(errors)
@@ -130,13 +153,22 @@ def main():
     print("Loading Data")
     data = np.load('im2spain_data.npz')
 
-    train_features = data['train_features']  # [N_train, dim] array
-    test_features = data['test_features']    # [N_test, dim] array
+    # Features are cast to contiguous float32 so the neighbor search and the
+    # Part H matrix products run in float32, halving the memory traffic
+    train_features = np.ascontiguousarray(data['train_features'], dtype=np.float32)  # [N_train, dim] array
+    test_features = np.ascontiguousarray(data['test_features'], dtype=np.float32)    # [N_test, dim] array
     train_labels = data['train_labels']      # [N_train, 2] array of (lat, lon) coords
     test_labels = data['test_labels']        # [N_test, 2] array of (lat, lon) coords
     train_files = data['train_files']        # [N_train] array of strings
     test_files = data['test_files']          # [N_test] array of strings
 
+    # Scale (lat, lon) to miles once so that every displacement error is a plain
+    # Euclidean norm. Assume 1 degree latitude is 69 miles and 1 degree longitude
+    # is 52 miles.
+    miles_per_degree = np.array([69, 52])
+    train_labels_mi = train_labels * miles_per_degree  # [N_train, 2] array
+    test_labels_mi = test_labels * miles_per_degree    # [N_test, 2] array
+
     # Data Information
     print('Train Data Count:', train_features.shape[0])
 
@@ -144,15 +176,11 @@ def main():
     plot_data(train_features, train_labels)
 
     # Part C: Find the 5 nearest neighbors of test image 53633239060.jpg
-    knn = NearestNeighbors(n_neighbors=3).fit(train_features)
+    knn = NearestNeighbors(n_neighbors=3, algorithm='brute').fit(train_features)
     
     #my code starts
     # Find the index of the test image file in the test files list
-    test_index = None
-    for i, file_name in enumerate(test_files):
-        if file_name == '53633239060.jpg':
-            test_index = i
-            break
+    test_index = int(np.flatnonzero(test_files == '53633239060.jpg')[0])
 
     # Use knn to get the 3 nearest neighbors of the features of the test image
     distances, indices = knn.kneighbors(test_features[test_index:test_index+1])
@@ -191,39 +219,56 @@ def main():
 
     # Part D: establish a naive baseline of predicting the mean of the training set
     ##### TODO(d): Your Code Here #####
-    baseline_predictions = constant_baseline(train_labels, test_features)
+    baseline_predictions = constant_baseline(train_labels_mi, test_features)
     # Calculate the mean displacement error (MDE) in miles
-    mde = np.mean(np.sqrt(np.sum((test_labels - baseline_predictions) ** 2, axis=1)))
+    mde = np.mean(np.linalg.norm(test_labels_mi - baseline_predictions, axis=1))
     print(f"Constant Baseline Mean Displacement Error (miles): {mde:.2f}")
 
     # Part E: complete grid_search to find the best value of k
-    grid_search(train_features, train_labels, test_features, test_labels)
+    grid_search(train_features, train_labels_mi, test_features, test_labels_mi)
 
     # Parts G: rerun grid search after modifications to find the best value of k
-    grid_search(train_features, train_labels, test_features, test_labels, is_weighted=True)
+    grid_search(train_features, train_labels_mi, test_features, test_labels_mi, is_weighted=True)
 
     # Part H: compare to linear regression for different # of training points
     mean_errors_lin = []
     mean_errors_nn = []
     ratios = np.arange(0.1, 1.1, 0.1)
+    # Each subset is a prefix of the next one, so linear regression is solved
+    # from normal equations (X^T X) w = X^T y that are accumulated block by
+    # block instead of refitting on every subset. A column of ones stands in
+    # for the intercept.
+    dim = train_features.shape[1] + 1
+    XtX = np.zeros((dim, dim))
+    Xty = np.zeros((dim, train_labels.shape[1]))
+    test_design = np.hstack([test_features, np.ones((len(test_features), 1))])
+    prev_samples = 0
+    # For the same reason, the test-to-train distances are computed once and each
+    # subset's nearest neighbors are selected from its first num_samples columns
+    test_train_distances = euclidean_distances(test_features, train_features)
     for r in ratios:
         num_samples = int(r * len(train_features))
         ##### TODO(h): Your Code Here #####
-        # Select a subset of training data based on the current ratio
-        train_features_subset = train_features[:num_samples]
-        train_labels_subset = train_labels[:num_samples]
-
-        # Train linear regression model
-        lin_reg_model = LinearRegression()
-        lin_reg_model.fit(train_features_subset, train_labels_subset)
-        lin_reg_predictions = lin_reg_model.predict(test_features)
+        # Select a subset of training labels based on the current ratio; the
+        # subset's neighbors come from test_train_distances below
+        train_labels_subset = train_labels_mi[:num_samples]
+
+        # Train linear regression model on the rows added since the last ratio
+        block = np.hstack([train_features[prev_samples:num_samples],
+                           np.ones((num_samples - prev_samples, 1))])
+        XtX += block.T @ block
+        Xty += block.T @ train_labels_mi[prev_samples:num_samples]
+        prev_samples = num_samples
+        weights = np.linalg.solve(XtX + 1e-6 * np.eye(dim), Xty)
+        lin_reg_predictions = test_design @ weights
 
         # Calculate mean displacement error for linear regression
-        lin_reg_mde = np.mean(np.sqrt(np.sum((test_labels - lin_reg_predictions) ** 2, axis=1)))
+        lin_reg_mde = np.mean(np.linalg.norm(test_labels_mi - lin_reg_predictions, axis=1))
         mean_errors_lin.append(lin_reg_mde)
 
         # Train k-NN model and perform grid search to find the best value of k
-        knn_mde = grid_search(train_features_subset, train_labels_subset, test_features, test_labels)
+        knn_mde = grid_search(None, train_labels_subset, test_features, test_labels_mi,
+                              neighbors=prefix_neighbors(test_train_distances, num_samples, 100))
         mean_errors_nn.append(knn_mde)
 
         print(f'\nTraining set ratio: {r} ({num_samples})')